@@ -1,17 +1,28 @@
+import cProfile
+import glob
+import hmac
 import itertools
+import os
+import random
+import re
 from datetime import timedelta
 
 import arrow
+import cachetools
 import flask
 import hashlib
 import requests
 import requests_cache
 import simplejson as json
-from flask import make_response, request, current_app, jsonify
+from flask import make_response, request, current_app, jsonify, Response, stream_with_context
 from flask_cache import Cache
 from functools import update_wrapper
 from simplekv.fs import FilesystemStore
 import dateparser
+import threading
+import time
+import uuid
+import zlib
 from collections import OrderedDict
 
 
@@ -65,6 +76,57 @@ if hasattr(settings, 'redis_host'):
 else:
     redis_host = 'localhost'
 
+# Redis URL, e.g. redis://redis:6379, used instead of redis_host if set. Any database in the URL is ignored.
+# Defaults to the REDIS_URL environment variable, only if neither redis_url nor redis_host is set.
+if hasattr(settings, 'redis_url'):
+    redis_url = settings.redis_url
+elif not hasattr(settings, 'redis_host'):
+    redis_url = os.environ.get('REDIS_URL')
+else:
+    redis_url = None
+
+# Redis Sentinel addresses, e.g. [('sentinel1', 26379), ('sentinel2', 26379)], used instead of redis_host if set.
+if hasattr(settings, 'redis_sentinels'):
+    redis_sentinels = settings.redis_sentinels
+else:
+    redis_sentinels = None
+
+# Name of the Redis Sentinel master.
+if hasattr(settings, 'redis_sentinel_service'):
+    redis_sentinel_service = settings.redis_sentinel_service
+else:
+    redis_sentinel_service = 'mymaster'
+
+# Redis Cluster startup nodes, e.g. [{'host': 'redis1', 'port': 6379}], shards all data across the cluster if set.
+if hasattr(settings, 'redis_cluster_nodes'):
+    redis_cluster_nodes = settings.redis_cluster_nodes
+else:
+    redis_cluster_nodes = None
+
+# Timeout in seconds for Redis commands.
+if hasattr(settings, 'redis_socket_timeout'):
+    redis_socket_timeout = settings.redis_socket_timeout
+else:
+    redis_socket_timeout = 5
+
+# Timeout in seconds for connecting to Redis.
+if hasattr(settings, 'redis_connect_timeout'):
+    redis_connect_timeout = settings.redis_connect_timeout
+else:
+    redis_connect_timeout = 5
+
+# Check (PING) pooled Redis connections idle for more than N seconds before use.
+if hasattr(settings, 'redis_health_check_interval'):
+    redis_health_check_interval = settings.redis_health_check_interval
+else:
+    redis_health_check_interval = 30
+
+# Maximum number of pooled connections per Redis database (or per cluster node).
+if hasattr(settings, 'redis_max_connections'):
+    redis_max_connections = settings.redis_max_connections
+else:
+    redis_max_connections = 50
+
 
 # expiry time for AS events stored/cached in Redis
 if hasattr(settings, 'redis_ttl'):
@@ -98,6 +160,357 @@ if hasattr(settings, 'event_ids'):
 else:
     event_ids = False
 
+# Append activities to a persistent, time-ordered log and page over that log, rather than
+# slicing the current collection. Every page except the last is frozen once full.
+# N.B. page_size must not change once the log has been written, or page numbers will shift.
+if hasattr(settings, 'stable_pages'):
+    stable_pages = settings.stable_pages
+else:
+    stable_pages = False
+
+# Cache-Control max-age for frozen (full, non-last) pages when using stable_pages.
+if hasattr(settings, 'frozen_page_max_age'):
+    frozen_page_max_age = settings.frozen_page_max_age
+else:
+    frozen_page_max_age = 31536000  # default to 1 year.
+
+# Log entries and frozen pages are persisted forever, so their ids must not depend on the request Host.
+if stable_pages and not service_base_address:
+    raise ValueError('stable_pages requires service_base_address to be set')
+
+# Allow gzip compression of the bulk NDJSON dump, if requested by the client.
+if hasattr(settings, 'dump_gzip'):
+    dump_gzip = settings.dump_gzip
+else:
+    dump_gzip = True
+
+# Profile this fraction (0.0 to 1.0) of /as/ and /activity/ requests. 0 to only profile on request.
+if hasattr(settings, 'profile_sample_rate'):
+    profile_sample_rate = settings.profile_sample_rate
+else:
+    profile_sample_rate = 0
+
+# Profile (bypassing Flask caching) any /as/ or /activity/ request with this value in the X-Profile-Token header.
+if hasattr(settings, 'profile_token'):
+    profile_token = settings.profile_token
+else:
+    profile_token = None
+
+# Directory to write profiles to, as cProfile/pstats .prof files.
+if hasattr(settings, 'profile_dir'):
+    profile_dir = settings.profile_dir
+else:
+    profile_dir = './profiles'
+
+# Number of profiles to keep in profile_dir, the oldest are deleted.
+if hasattr(settings, 'profile_retention'):
+    profile_retention = settings.profile_retention
+else:
+    profile_retention = 50
+
+profiling = bool(profile_sample_rate or profile_token)
+
+# Maximum size in bytes of the in-process (L1) cache in front of the simplekv store. 0 to disable.
+if hasattr(settings, 'l1_cache_size'):
+    l1_cache_size = settings.l1_cache_size
+else:
+    l1_cache_size = 32 * 1024 * 1024  # default to 32MB.
+
+# Expiry time for items in the in-process (L1) cache. None for LRU eviction only.
+if hasattr(settings, 'l1_cache_ttl'):
+    l1_cache_ttl = settings.l1_cache_ttl
+else:
+    l1_cache_ttl = 300  # default to 5 minutes.
+
+# Never keep events in the L1 cache for longer than they are kept in Redis.
+if use_redis and redis_ttl and (not l1_cache_ttl or l1_cache_ttl > redis_ttl):
+    l1_cache_ttl = redis_ttl
+
+
+class CountingLRUCache(cachetools.LRUCache):
+    """
+    LRU cache which counts evictions.
+    """
+    evictions = 0
+    expirations = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return super(CountingLRUCache, self).popitem()
+
+    def clear(self):
+        # clear() empties the cache with popitem(), which are not evictions.
+        evictions = self.evictions
+        super(CountingLRUCache, self).clear()
+        self.evictions = evictions
+
+
+class CountingTTLCache(cachetools.TTLCache):
+    """
+    TTL (and LRU) cache which counts evictions, and expirations separately.
+    """
+    evictions = 0
+    expirations = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return super(CountingTTLCache, self).popitem()
+
+    def clear(self):
+        # clear() empties the cache with popitem(), which are not evictions.
+        evictions = self.evictions
+        super(CountingTTLCache, self).clear()
+        self.evictions = evictions
+
+    def expire(self, time=None):
+        stored = cachetools.Cache.__len__(self)
+        super(CountingTTLCache, self).expire(time)
+        self.expirations += stored - cachetools.Cache.__len__(self)
+
+
+class TieredStore(object):
+    """
+    Bounded in-process (L1) cache in front of a simplekv store.
+
+    The L1 cache is capped at max_bytes of stored values. If a Redis client is passed, writes are
+    published on a Redis channel, and every process drops the written key from its own L1 cache. The L1
+    cache is cleared whenever the subscription is (re)established, so missed messages cannot leave
+    stale items behind. Values read or written are only cached if no invalidation arrived in the meantime,
+    so an invalidation cannot be overtaken by the (older) value it invalidates.
+
+    The subscriber thread is started on first use in each process, as threads do not survive a fork
+    (e.g. a preforking uwsgi master).
+
+    Anything not defined here (e.g. the redis attribute of a RedisStore) is passed through to the store.
+    """
+    channel = 'as_l1_invalidate'
+
+    def __init__(self, kv_store, max_bytes, ttl=None, redis_client=None):
+        self.store = kv_store
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.generation = 0  # incremented on every invalidation.
+        self.lock = threading.Lock()
+        self.instance = uuid.uuid4().hex
+        self.redis_client = redis_client
+        if not max_bytes:
+            self.l1 = None
+        elif ttl:
+            self.l1 = CountingTTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=len)
+        else:
+            self.l1 = CountingLRUCache(maxsize=max_bytes, getsizeof=len)
+        self.subscriber_pid = None
+
+    def start_subscriber(self):
+        """
+        Start the invalidation subscriber thread, if not already running in this process.
+        """
+        if self.redis_client is None or self.subscriber_pid == os.getpid():
+            return
+        with self.lock:
+            if self.subscriber_pid == os.getpid():
+                return
+            self.subscriber_pid = os.getpid()
+        subscriber = threading.Thread(target=self.subscribe, name='l1-invalidation')
+        subscriber.daemon = True
+        subscriber.start()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def get(self, key, l1=True):
+        """
+        Get a value, from the L1 cache if present.
+
+        :param key: store key
+        :param l1: set to False to bypass the L1 cache, e.g. when holding a lock over the key
+        :return: bytes
+        """
+        if self.l1 is None or not l1:
+            return self.store.get(key)
+        self.start_subscriber()
+        with self.lock:
+            value = self.l1.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self.generation
+        value = self.store.get(key)
+        self.cache(key, value, generation)
+        return value
+
+    def put(self, key, data, l1=True, invalidate=True, **kwargs):
+        """
+        Put a value in the store and the L1 cache, and invalidate the key in other processes.
+
+        :param key: store key
+        :param data: bytes
+        :param l1: set to False to leave the value out of the L1 cache
+        :param invalidate: set to False for keys no process can hold a stale copy of, i.e. keys written
+            only once, or never read through the L1 cache
+        :param kwargs: passed to the store, e.g. ttl_secs
+        :return: key
+        """
+        if self.l1 is not None:
+            self.start_subscriber()
+        generation = self.generation
+        result = self.store.put(key, data, **kwargs)
+        if l1:
+            self.cache(key, data, generation)
+        elif invalidate:
+            self.invalidate(key)
+        if invalidate:
+            self.publish(key)
+        return result
+
+    def delete(self, key, invalidate=True):
+        result = self.store.delete(key)
+        if invalidate:
+            self.invalidate(key)
+            self.publish(key)
+        return result
+
+    def cache(self, key, value, generation):
+        """
+        Put a value in the L1 cache, unless anything was invalidated since generation.
+
+        :param key: store key
+        :param value: bytes
+        :param generation: self.generation before the value was read from, or written to, the store
+        """
+        if self.l1 is None:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            try:
+                self.l1[key] = value
+            except ValueError:  # value larger than the whole cache.
+                self.uncacheable += 1
+
+    def invalidate(self, key=None):
+        """
+        Drop a key, or everything if no key, from the L1 cache.
+
+        :param key: store key
+        """
+        if self.l1 is None:
+            return
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.l1.clear()
+            else:
+                self.l1.pop(key, None)
+
+    def publish(self, key):
+        if self.l1 is not None and self.redis_client is not None:
+            self.redis_client.publish(self.channel, self.instance + ' ' + key)
+
+    def subscribe(self):
+        """
+        Drop keys written by other processes from the L1 cache. Runs forever in a daemon thread.
+        """
+        while True:
+            # noinspection PyBroadException
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.invalidate()
+                while True:
+                    # Poll, rather than block, so idle subscriptions are not dropped by the socket timeout.
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    data = message['data']
+                    if isinstance(data, bytes):
+                        data = data.decode('ascii')
+                    instance, key = data.split(' ', 1)
+                    if instance != self.instance:
+                        self.invalidate(key)
+            except Exception as e:
+                print('L1 cache invalidation subscription lost', e)
+                self.invalidate()
+                time.sleep(1)
+
+    def stats(self):
+        """
+        Hit, miss and eviction statistics for the L1 cache.
+
+        :return: dict
+        """
+        if self.l1 is None:
+            return {'enabled': False}
+        with self.lock:
+            return OrderedDict([('enabled', True), ('hits', self.hits), ('misses', self.misses),
+                                ('evictions', self.l1.evictions), ('expirations', self.l1.expirations),
+                                ('uncacheable', self.uncacheable), ('items', len(self.l1)),
+                                ('bytes', self.l1.currsize), ('max_bytes', self.l1.maxsize)])
+
+# Pooled Redis clients, one per logical database (or one for the whole cluster).
+redis_clients = {}
+
+
+def redis_client(db):
+    """
+    Return the shared, pooled Redis client for a logical database.
+
+    Databases are 0 for requests_cache, 1 for the simplekv store of events and pages and 2 for Flask caching.
+    Redis Cluster has no databases, so the same client is returned for each, and data is namespaced by key
+    prefix (see redis_prefix). Events, stable page log entries, frozen pages and Flask cached pages are spread
+    across the cluster nodes, as are the as_live_<md5> member flags. Single keys (as_log_count, as_log_digest
+    and the requests_cache hashes) are not.
+
+    :param db: Redis database number
+    :return: redis.StrictRedis (or rediscluster.RedisCluster) client
+    """
+    if redis_cluster_nodes:
+        db = 0
+    if db in redis_clients:
+        return redis_clients[db]
+    import redis
+    connection_kwargs = {'socket_timeout': redis_socket_timeout,
+                         'socket_connect_timeout': redis_connect_timeout,
+                         'health_check_interval': redis_health_check_interval,
+                         'retry_on_timeout': True}
+    if redis_cluster_nodes:
+        from rediscluster import RedisCluster
+        client = RedisCluster(startup_nodes=redis_cluster_nodes, max_connections=redis_max_connections,
+                              max_connections_per_node=True, skip_full_coverage_check=True, **connection_kwargs)
+    elif redis_sentinels:
+        from redis.sentinel import Sentinel
+        sentinel = Sentinel(redis_sentinels, socket_timeout=redis_socket_timeout,
+                            socket_connect_timeout=redis_connect_timeout)
+        client = sentinel.master_for(redis_sentinel_service, db=db, max_connections=redis_max_connections,
+                                     **connection_kwargs)
+    elif redis_url:
+        # Drop any database (path or query) from the URL, so each logical database stays separate.
+        url = redis_url
+        if url.startswith(('redis://', 'rediss://')):
+            url = re.match(r'^[a-z]+://[^/?#]*', url).group(0)
+        client = redis.StrictRedis(connection_pool=redis.ConnectionPool.from_url(
+            url, db=db, max_connections=redis_max_connections, **connection_kwargs))
+    else:
+        client = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+            host=redis_host, db=db, max_connections=redis_max_connections, **connection_kwargs))
+    redis_clients[db] = client
+    return client
+
+
+def redis_prefix(db):
+    """
+    Key prefix standing in for the logical database when using Redis Cluster.
+
+    :param db: Redis database number
+    :return: prefix string, empty if not using Redis Cluster
+    """
+    if redis_cluster_nodes:
+        return 'as_db{}_'.format(db)
+    return ''
+
+
 # Use Redis for local caching.
 if use_redis:
     """
@@ -105,13 +518,17 @@ if use_redis:
     The simplekv store will use settings.redis_ttl to expire items in Redis (if required).
     """
     from simplekv.memory.redisstore import RedisStore
-    import redis
+    from simplekv.decorator import PrefixDecorator
 
-    store = RedisStore(redis.StrictRedis(host=redis_host, db=1))
+    kv_store = RedisStore(redis_client(1))
+    if redis_prefix(1):
+        kv_store = PrefixDecorator(redis_prefix(1), kv_store)
+    store = TieredStore(kv_store, max_bytes=l1_cache_size, ttl=l1_cache_ttl, redis_client=redis_client(1))
 
     if flask_cache_timeout:
-        cache = Cache(app, config={'CACHE_TYPE': 'redis', 'CACHE_REDIS_DB': 2,
-                                   'CACHE_REDIS_HOST': redis_host,
+        # Flask-Cache accepts a client in place of a host.
+        cache = Cache(app, config={'CACHE_TYPE': 'redis', 'CACHE_REDIS_HOST': redis_client(2),
+                                   'CACHE_KEY_PREFIX': redis_prefix(2),
                                    'CACHE_DEFAULT_TIMEOUT': flask_cache_timeout})
     else:
         cache = Cache(app, config={'CACHE_TYPE': 'null'})
@@ -122,14 +539,14 @@ if use_redis:
         
         Does not cache 40x results.
         """
-        requests_cache.install_cache('iiif_cache', backend='redis', connection=redis.StrictRedis(host=redis_host, db=0),
+        requests_cache.install_cache(redis_prefix(0) + 'iiif_cache', backend='redis', connection=redis_client(0),
                                      expire_after=cache_requests_timeout,
                                      allowable_codes=[200])
 else:
     """ 
     Use sqlite for local requests caching.
     """
-    store = FilesystemStore(settings.simplekv_path)
+    store = TieredStore(FilesystemStore(settings.simplekv_path), max_bytes=l1_cache_size, ttl=l1_cache_ttl)
 
     if flask_cache_timeout:
         cache = Cache(app, config={'CACHE_TYPE': 'simple',  'CACHE_DEFAULT_TIMEOUT': flask_cache_timeout})
@@ -148,6 +565,15 @@ else:
                                      allowable_codes=[200])
 
 
+# Guards appends to the stable page log when not using Redis (single process, threaded).
+log_thread_lock = threading.Lock()
+
+# Store keys which may be served as activities: MD5 hashes of member @ids and stable page log entries.
+activity_key = re.compile(r'^([0-9a-f]{32}|as_log_[0-9]+)$')
+
+# Only one request is profiled at a time.
+profile_lock = threading.Lock()
+
 # ==============================================================
 
 
@@ -205,6 +631,88 @@ def crossdomain(origin=None, methods=None, headers=None,
     return decorator
 
 
+def profile_forced():
+    """
+    True if the current request asked to be profiled with a valid X-Profile-Token header.
+
+    Used to bypass Flask caching, so the profile covers building the response.
+
+    :return: boolean
+    """
+    return flask.g.get('profile_forced', False)
+
+
+def prune_profiles():
+    """
+    Delete the oldest profiles in profile_dir, keeping profile_retention profiles.
+    """
+    profiles = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+    for old_profile in profiles[:max(len(profiles) - profile_retention, 0)]:
+        try:
+            os.remove(old_profile)
+        except OSError:
+            pass
+
+
+def write_profile(profile, name):
+    """
+    Write a profile to profile_dir and prune old profiles.
+
+    Errors are printed rather than raised, so a failure to write a profile never fails the request.
+
+    :param profile: cProfile.Profile
+    :param name: name of the profiled view
+    """
+    try:
+        try:
+            os.makedirs(profile_dir)
+        except OSError:  # already exists, e.g. created by another process.
+            if not os.path.isdir(profile_dir):
+                raise
+        profile_file = os.path.join(profile_dir, '{:.6f}_{}_{}.prof'.format(time.time(), name, os.getpid()))
+        profile.dump_stats(profile_file)
+        prune_profiles()
+        if verbose:
+            print('Profiled', request.path, 'to', profile_file)
+    except (OSError, IOError) as e:
+        print('Could not write profile', e)
+
+
+def profiled(f):
+    """
+    Decorate a Flask view to write a cProfile profile of sampled, or requested, requests to profile_dir.
+
+    Returns the view unchanged if neither settings.profile_sample_rate nor settings.profile_token is set.
+
+    :param f: Flask view
+    :return: decorated Flask view
+    """
+    if not profiling:
+        return f
+
+    def wrapped_function(*args, **kwargs):
+        token = request.headers.get('X-Profile-Token')
+        forced = bool(profile_token and token and hmac.compare_digest(token.encode('utf-8'),
+                                                                      profile_token.encode('utf-8')))
+        if not (forced or random.random() < profile_sample_rate):
+            return f(*args, **kwargs)
+        if not profile_lock.acquire(False):  # already profiling another request.
+            return f(*args, **kwargs)
+        try:
+            flask.g.profile_forced = forced
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                profile.disable()
+                write_profile(profile, f.__name__)
+        finally:
+            profile_lock.release()
+
+    return update_wrapper(wrapped_function, f)
+
+
 def custom_error(message, status_code):
     """
     Return a custom error message as a simple Flask response
@@ -273,7 +781,49 @@ def chunked_members(num_memb, memb, chunksize=10):
         return
 
 
-def member_to_as_item(item, collection, url_base, end_time=str(arrow.utcnow()), check_modified=check_last_modified):
+def as_object(item, collection):
+    """
+    Convert manifest/member to the object of an ActivityStreams event.
+
+    :param item: Python object for the manifest/member item
+    :param collection: IIIF Collection
+    :return: object for the ActivityStreams event
+    """
+    if item['@type'] == 'sc:Manifest':
+        obj_type = 'Manifest'
+    elif item['@type'] == 'sc:Collection':
+        obj_type = 'Collection'
+    else:
+        obj_type = item['@type']
+    return {'id': item['@id'], 'type': obj_type, 'label': item['label'], 'within': collection}
+
+
+def new_activity(as_obj, end_time, verb=None):
+    """
+    Create an ActivityStreams event, with the optional verb, actor and instrument settings.
+
+    :param as_obj: object for the ActivityStreams event
+    :param end_time: time
+    :param verb: activity type, defaults to settings.verb or 'Update'
+    :return: object for the ActivityStreams event
+    """
+    obj = {'object': as_obj, 'endTime': end_time}
+    # Grab optional settings
+    if verb:
+        obj['type'] = verb
+    elif hasattr(settings, 'verb'):
+        obj['type'] = settings.verb
+    else:
+        obj['type'] = 'Update'
+    if hasattr(settings, 'actor'):
+        obj['actor'] = settings.actor
+    if hasattr(settings, 'instrument'):
+        obj['instrument'] = settings.instrument
+    return obj
+
+
+def member_to_as_item(item, collection, url_base, end_time=str(arrow.utcnow()), check_modified=check_last_modified,
+                      l1=True):
     """
     Convert manifest/member to an ActivityStreams event.
 
@@ -300,12 +850,13 @@ def member_to_as_item(item, collection, url_base, end_time=str(arrow.utcnow()),
     :param url_base: base to use when constructing the URI for the dereferenceable event
     :param end_time: time, defaults to utcnow()
     :param check_modified: if True, attempt to de-reference the manifest and check the last-modified date.
+    :param l1: set to False to bypass the in-process cache, e.g. when reading every event
     :return: object for the ActivityStreams event
     """
     # hash the manifest URI to create a key for the 'event'.
     key = hashlib.md5(item['@id'].encode('ascii')).hexdigest()
     try:
-        cached_obj = store.get(key)
+        cached_obj = store.get(key, l1=l1)
     except KeyError:
         cached_obj = None
     if cached_obj:  # check for cached object, N.B. Redis uses ttl to expire after a time set in settings.py
@@ -322,32 +873,16 @@ def member_to_as_item(item, collection, url_base, end_time=str(arrow.utcnow()),
                     last_m = arrow.get(dateparser.parse(h['last-modified']))
                     if last_m:
                         end_time = str(last_m)
-        if item['@type'] == 'sc:Manifest':
-            obj_type = 'Manifest'
-        elif item['@type'] == 'sc:Collection':
-            obj_type = 'Collection'
-        else:
-            obj_type = item['@type']
-        obj = {'object': {'id': item['@id'], 'type': obj_type, 'label': item['label'],
-                          'within': collection}, 'endTime': end_time}
-        # Grab optional settings
-        if hasattr(settings, 'verb'):
-            obj['type'] = settings.verb
-        else:
-            obj['type'] = 'Update'
-        if hasattr(settings, 'actor'):
-            obj['actor'] = settings.actor
-        if hasattr(settings, 'instrument'):
-            obj['instrument'] = settings.instrument
+        obj = new_activity(as_object(item, collection), end_time=end_time)
         if verbose:
             print('=========NOT from Cache=======')
             print(json.dumps(obj, indent=4))
         if event_ids:
             obj['id'] = url_base.replace('/as/', '/activity/') + key
             if use_redis:
-                store.put(key, json.dumps(obj).encode('ascii'), ttl_secs=redis_ttl)
+                store.put(key, json.dumps(obj).encode('ascii'), l1=l1, ttl_secs=redis_ttl)
             else:
-                store.put(key, json.dumps(obj).encode('ascii'))
+                store.put(key, json.dumps(obj).encode('ascii'), l1=l1)
         return obj
 
 
@@ -378,6 +913,32 @@ def ceildiv(a, b):
     return -(-a // b)
 
 
+def page_frame(id_base, count, first, last):
+    """
+    Generate the ActivityStreams page wrapper (context, id, partOf, prev, next) for a results page.
+
+    :param id_base: the URI the site lives at
+    :param count: page number
+    :param first: True if this is the first page
+    :param last: True if this is the last page
+    :return: OrderedDict for the page, without orderedItems
+    """
+    results_page = OrderedDict()
+    results_page['@context'] = [
+                        "http://iiif.io/api/presentation/2/context.json",
+                        "https://www.w3.org/ns/activitystreams"
+                        ]
+    results_page['@id'] = id_base + str(count)
+    results_page['type'] = 'OrderedCollectionPage'
+    results_page['partOf'] = {'id': id_base, 'type': 'OrderedCollection'}
+    if not first:
+        results_page['prev'] = {'id': id_base + str(count - 1), 'type': 'OrderedCollectionPage'}
+    if not last:
+        results_page['next'] = {'id': id_base + str(count + 1), 'type': 'OrderedCollectionPage'}
+        # results_page['last'] = {'id': id_base + str(result_size), 'type': 'OrderedCollectionPage'}
+    return results_page
+
+
 def as_paged(number_of_members, member_list, collection, id_base, page_size):
     """
     Generator function to return ActivityStreams pages with first, previous, next, last, etc.
@@ -401,19 +962,7 @@ def as_paged(number_of_members, member_list, collection, id_base, page_size):
             first = True
         elif count == result_size:
             last = True
-        results_page = OrderedDict()
-        results_page['@context'] = [
-                            "http://iiif.io/api/presentation/2/context.json",
-                            "https://www.w3.org/ns/activitystreams"
-                            ]
-        results_page['@id'] = id_base + str(count)
-        results_page['type'] = 'OrderedCollectionPage'
-        results_page['partOf'] = {'id': id_base, 'type': 'OrderedCollection'}
-        if not first:
-            results_page['prev'] = {'id': id_base + str(count - 1), 'type': 'OrderedCollectionPage'}
-        if not last:
-            results_page['next'] = {'id': id_base + str(count + 1), 'type': 'OrderedCollectionPage'}
-            # results_page['last'] = {'id': id_base + str(result_size), 'type': 'OrderedCollectionPage'}
+        results_page = page_frame(id_base=id_base, count=count, first=first, last=last)
         results_page['orderedItems'] = as_page['items']
         yield results_page, result_size
         count += 1
@@ -476,19 +1025,267 @@ def gen_top(service_uri, no_pages, num_mem, label=None):
     return top
 
 
+def log_lock():
+    """
+    Lock guarding appends to the stable page log.
+
+    Uses a Redis lock when using Redis, so that multiple workers do not append the same activity twice.
+
+    :return: context manager
+    """
+    if use_redis:
+        return redis_client(1).lock(redis_prefix(1) + 'as_log_lock', timeout=300, blocking_timeout=300)
+    else:
+        return log_thread_lock
+
+
+def renew_log_lock(lock):
+    """
+    Reset the expiry of a Redis log lock, so long appends do not outlive it.
+
+    :param lock: lock returned by log_lock
+    """
+    if use_redis:
+        lock.reacquire()
+
+
+def store_get_json(key, default=None, l1=True, object_pairs_hook=None):
+    """
+    Get a JSON object from the simplekv store.
+
+    :param key: store key
+    :param default: returned if the key is not in the store
+    :param l1: set to False to bypass the in-process cache
+    :param object_pairs_hook: passed to json.loads, e.g. OrderedDict to preserve key order
+    :return: Python object
+    """
+    try:
+        return json.loads(store.get(key, l1=l1), object_pairs_hook=object_pairs_hook)
+    except KeyError:
+        return default
+
+
+def log_count(l1=True):
+    """
+    Number of activities appended to the stable page log.
+
+    :param l1: set to False to bypass the in-process cache
+    :return: integer
+    """
+    return store_get_json('as_log_count', default=0, l1=l1)
+
+
+def members_digest(members):
+    """
+    Digest of a set of member keys, independent of their order.
+
+    :param members: MD5 hex keys of the members
+    :return: string, number of members and XOR of their keys
+    """
+    xor = 0
+    for key in members:
+        xor ^= int(key, 16)
+    return '{}_{:032x}'.format(len(members), xor)
+
+
+def sync_log(member_list, collection, url_base):
+    """
+    Append activities for members added to, or removed from, the collection since the last sync.
+
+    New members are appended as new activities, members no longer in the collection are appended as
+    Delete activities, all with the time of the sync, so the log is in time order (newest last). Log entries
+    are built afresh rather than from the cached events, are never rewritten, and are persisted without a ttl.
+
+    Members in the log are flagged individually (as_live_<md5> keys), and a digest of the whole set is kept
+    in as_log_digest, so an unchanged collection is detected without reading the flags.
+
+    :param member_list: list of member items
+    :param collection: IIIF Collection @id
+    :param url_base: base to use when constructing the URI for the dereferenceable event
+    :return: number of activities in the log
+    """
+    current = OrderedDict()
+    for item in member_list:
+        current[hashlib.md5(item['@id'].encode('ascii')).hexdigest()] = item
+    digest = members_digest(current)
+    # Fast path, if nothing has been added or removed. Read from the store, as pub/sub invalidation
+    # is asynchronous, so cached values could lag behind each other.
+    if store_get_json('as_log_digest', l1=False) == digest:
+        return log_count(l1=False)
+    lock = log_lock()
+    with lock:
+        count = log_count(l1=False)
+        live = set(key[len('as_live_'):] for key in store.iter_keys(prefix='as_live_'))
+        now = str(arrow.utcnow())
+        new_events = []
+        for key, item in current.items():
+            if key not in live:
+                new_events.append((key, new_activity(as_object(item, collection), end_time=now)))
+        for key in [k for k in live if k not in current]:
+            new_events.append((key, new_activity(store_get_json('as_live_' + key, l1=False), end_time=now,
+                                                 verb='Delete')))
+        if not new_events:
+            store.put('as_log_digest', json.dumps(digest).encode('ascii'))
+            return count
+        for appended, (key, obj) in enumerate(new_events):
+            if appended and appended % 1000 == 0:
+                renew_log_lock(lock)
+            log_key = 'as_log_' + str(count)
+            if event_ids:
+                obj['id'] = url_base.replace('/as/', '/activity/') + log_key
+            # Log entries are never rewritten, and member flags are only read from the store.
+            store.put(log_key, json.dumps(obj).encode('ascii'), invalidate=False)
+            if obj['type'] == 'Delete':
+                store.delete('as_live_' + key, invalidate=False)
+            else:
+                store.put('as_live_' + key,
+                          json.dumps({k: obj['object'][k] for k in ('id', 'type', 'within')}).encode('ascii'),
+                          l1=False, invalidate=False)
+            count += 1
+        store.put('as_log_count', json.dumps(count).encode('ascii'))
+        store.put('as_log_digest', json.dumps(digest).encode('ascii'))
+        if verbose:
+            print('Appended', len(new_events), 'activities to the log')
+    return count
+
+
+def frozen_page_key(position, page_size):
+    """
+    Store key for a frozen page of the stable page log.
+
+    :param position: page number
+    :param page_size: page size
+    :return: store key
+    """
+    return 'as_page_{}_{}'.format(page_size, position)
+
+
+def frozen_page(position, page_size):
+    """
+    Return a frozen page of the stable page log, if it has already been rendered.
+
+    :param position: page number
+    :param page_size: page size
+    :return: ActivityStreams page object, or None
+    """
+    return store_get_json(frozen_page_key(position, page_size), object_pairs_hook=OrderedDict)
+
+
+def stable_page(position, number_of_activities, id_base, page_size):
+    """
+    Return a page of the stable page log.
+
+    Frozen pages never change, so are persisted once rendered (see frozen_page).
+
+    :param position: page number
+    :param number_of_activities: number of activities in the log
+    :param id_base: the URI the site lives at
+    :param page_size: page size
+    :return: ActivityStreams page object, True if the page is frozen (or None, False if no such page)
+    """
+    result_size = ceildiv(number_of_activities, page_size)
+    if position < 1 or position > result_size:
+        return None, False
+    last = position == result_size
+    results_page = page_frame(id_base=id_base, count=position, first=position == 1, last=last)
+    start = (position - 1) * page_size
+    end = min(start + page_size, number_of_activities)
+    results_page['orderedItems'] = [store_get_json('as_log_' + str(i)) for i in range(start, end)]
+    if None in results_page['orderedItems']:
+        # e.g. evicted from Redis. Never freeze a page with missing entries.
+        raise KeyError('Missing stable page log entry on page ' + str(position))
+    if not last:
+        store.put(frozen_page_key(position, page_size), json.dumps(results_page).encode('ascii'), invalidate=False)
+    return results_page, not last
+
+
+def ndjson_activities(collection_uri, service_uri):
+    """
+    Generator function to yield every activity as a line of newline delimited JSON.
+
+    With stable_pages, syncs the log and then reads it directly from the store, so memory use does not grow
+    with the length of the stream.
+
+    Otherwise, converts each member of the collection, as the pages do.
+
+    Either way the in-process cache is bypassed, so a dump does not evict the hot pages.
+
+    :param collection_uri: IIIF Collection @id
+    :param service_uri: URI the pages live at
+    :return: generator of bytes, one activity per line
+    """
+    number_of_members, member_list = get_members(get_json_resource(resource_uri=collection_uri))
+    if stable_pages:
+        number_of_activities = sync_log(member_list=member_list, collection=collection_uri, url_base=service_uri)
+        return (store.get('as_log_' + str(i), l1=False) + b'\n' for i in range(number_of_activities))
+    return (json.dumps(member_to_as_item(member, collection=collection_uri,
+                                         url_base=service_uri, l1=False)).encode('utf-8') + b'\n'
+            for member in member_list)
+
+
+def gzip_chunks(chunks, chunk_size=65536):
+    """
+    Generator function to gzip compress a stream of bytes, yielding compressed output in chunks.
+
+    :param chunks: generator of bytes
+    :param chunk_size: approximate size of the uncompressed input to buffer before compressing
+    :return: generator of gzip compressed bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffered = []
+    buffered_size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= chunk_size:
+            compressed = compressor.compress(b''.join(buffered))
+            buffered = []
+            buffered_size = 0
+            if compressed:
+                yield compressed
+    yield compressor.compress(b''.join(buffered)) + compressor.flush()
+
+
+@app.after_request
+def conditional(response):
+    """
+    Answer If-None-Match requests with 304 Not Modified where the response has an ETag.
+
+    Runs after Flask caching, so cached responses are never stored as 304s.
+
+    :param response: Flask response
+    :return: Flask response
+    """
+    if response.get_etag()[0]:
+        return response.make_conditional(request)
+    return response
+
+
+@app.route('/stats/cache', methods=['GET'])
+@crossdomain(origin='*')  # add CORS
+def cache_stats():
+    """
+    Return hit, miss and eviction statistics for the in-process cache in this worker.
+
+    :return: Flask json
+    """
+    return jsonify(store.stats())
+
+
 @app.route('/activity/<path:identifier>', methods=['GET'])
 @crossdomain(origin='*')  # add CORS
-@cache.cached()  # Flask caching.
+@profiled  # optional profiling.
+@cache.cached(unless=profile_forced if profiling else None)  # Flask caching.
 def activity(identifier):
     """
     Return individual dereferenceable activity streams event.
 
     Pulls the json from simplekv store.
 
-    :param identifier: MD5 hash of the manifest/member @id
+    :param identifier: MD5 hash of the manifest/member @id, or as_log_<n> for stable_pages log entries
     :return: Flask json
     """
-    if identifier:
+    if identifier and activity_key.match(identifier):
         try:
             return jsonify(json.loads(store.get(identifier)))
         except KeyError:
@@ -497,10 +1294,38 @@ def activity(identifier):
         return custom_error('Activity not found', 404)
 
 
+@app.route('/dump/', methods=['GET'])
+@crossdomain(origin='*')  # add CORS
+def dump():
+    """
+    Stream every activity as newline delimited JSON, using chunked transfer encoding.
+
+    Gzip compressed if the client accepts gzip and settings.dump_gzip is not False.
+
+    :return: streamed Flask response
+    """
+    if not service_base_address:
+        service_address = request.url_root + 'as/'
+    else:
+        service_address = service_base_address
+    # noinspection PyBroadException
+    try:
+        lines = ndjson_activities(collection_uri=settings.collection, service_uri=service_address)
+    except Exception as e:
+        print(e)
+        return custom_error('An unexpected error occurred', 500)
+    headers = {'Vary': 'Accept-Encoding'}
+    if dump_gzip and request.accept_encodings['gzip']:
+        lines = gzip_chunks(lines)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers=headers)
+
+
 @app.route('/as/', defaults={'identifier': '0'})
 @app.route('/as/<path:identifier>', methods=['GET'])
 @crossdomain(origin='*')  # add CORS
-@cache.cached()  # Flask caching.
+@profiled  # optional profiling.
+@cache.cached(unless=profile_forced if profiling else None)  # Flask caching.
 def stream(identifier):
     """
     Activity Streams pages Flask app.
@@ -517,9 +1342,37 @@ def stream(identifier):
         service_address = service_base_address
     # noinspection PyBroadException
     try:
+        if stable_pages and page_number > 0:
+            # Frozen pages are served without syncing the log.
+            p = frozen_page(position=page_number, page_size=pagesize)
+            if p:
+                response = jsonify(p)
+                response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % frozen_page_max_age
+                return response
         collection_uri = settings.collection
         print(collection_uri)
         number_of_members, member_list = get_members(get_json_resource(resource_uri=collection_uri))
+        if stable_pages:
+            number_of_activities = sync_log(member_list=member_list, collection=collection_uri,
+                                            url_base=service_address)
+            if page_number == 0:
+                response = jsonify(gen_top(service_uri=service_address,
+                                           no_pages=ceildiv(number_of_activities, pagesize),
+                                           num_mem=number_of_activities,
+                                           label='Top level collection: ' + collection_uri))
+                frozen = False
+            else:
+                p, frozen = stable_page(position=page_number, number_of_activities=number_of_activities,
+                                        id_base=service_address, page_size=pagesize)
+                if not p:
+                    return custom_error('That results page does not exist', 404)
+                response = jsonify(p)
+            if frozen:
+                response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % frozen_page_max_age
+            else:
+                response.headers['Cache-Control'] = 'no-cache'
+                response.add_etag()
+            return response
         if page_number == 0:
             return jsonify(gen_top(service_uri=service_address, no_pages=ceildiv(number_of_members, pagesize),
                                    num_mem=number_of_members, label='Top level collection: ' + collection_uri))
@@ -51,3 +51,36 @@ verbose = True
 
 # if True, generate dereferenceable ids for events and cache/persist the JSON content.
 event_ids = True
+
+# if True, append events to a persistent log in time order (newest last) and page over the log.
+# Every page except the last is frozen once full, and served with immutable caching.
+# Do not change page_size once the log has been written. Requires service_base_address.
+stable_pages = False
+
+# Maximum size in bytes of the in-process cache in front of Redis/the filesystem store. 0 to disable.
+# Items written by other workers are dropped from the cache via Redis pub/sub.
+l1_cache_size = 33554432  # 32MB
+
+# Expire items in the in-process cache after N seconds. None for LRU eviction only.
+# Capped at redis_ttl if using Redis, so events expired in Redis are not served from the in-process cache.
+l1_cache_ttl = 300
+
+# Allow gzip compression of the newline delimited JSON dump at /dump/, if the client accepts gzip.
+dump_gzip = True
+
+# Redis connections are pooled and shared. Optional, use a URL, Sentinel or a Redis Cluster instead of redis_host.
+# redis_url = 'redis://localhost:6379'  # Any database in the URL is ignored.
+# redis_sentinels = [('sentinel1', 26379), ('sentinel2', 26379)]
+# redis_sentinel_service = 'mymaster'
+# Shard events, pages and caches across a Redis Cluster (requires redis-py-cluster).
+# redis_cluster_nodes = [{'host': 'redis1', 'port': 6379}, {'host': 'redis2', 'port': 6379}]
+redis_socket_timeout = 5  # Timeout in seconds for Redis commands.
+redis_connect_timeout = 5  # Timeout in seconds for connecting to Redis.
+redis_health_check_interval = 30  # Check pooled connections idle for N seconds before use.
+redis_max_connections = 50  # Maximum pooled connections per Redis database (or per cluster node).
+
+# Write cProfile (.prof) profiles of /as/ and /activity/ requests to profile_dir. No overhead if not set.
+profile_sample_rate = 0  # Fraction of requests to profile, e.g. 0.01.
+# profile_token = 'change-me'  # Profile (bypassing Flask caching) requests sending this X-Profile-Token header.
+profile_dir = './profiles'
+profile_retention = 50  # Number of profiles to keep.
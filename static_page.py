@@ -1,17 +1,35 @@
+import argparse
 import activity_streams
+import gzip
 import json
 from get_offline_settings import *
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write the activity stream to a static file.')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='write every activity as newline delimited JSON, rather than a single page')
+    parser.add_argument('--gzip', action='store_true', help='gzip compress the newline delimited JSON')
+    args = parser.parse_args()
+    if args.gzip and not args.ndjson:
+        parser.error('--gzip requires --ndjson')
     pagesize = settings_offline.page_size
     collection_uri = settings_offline.collection
-    number_of_members, member_list = activity_streams.get_members(
-        activity_streams.get_iiif_collection(collection_uri=collection_uri))
-    activity_streams_pages = activity_streams.streamer(number_of_members=number_of_members, member_list=member_list,
-                                                       top_uri=collection_uri,
-                                                       service_uri=settings_offline.service_base_address,
-                                                       size_of_page=number_of_members)
-    p = activity_streams.page_slicer(activity_streams_pages=activity_streams_pages, position=0)
-    with open(settings_offline.output_file, 'w') as output:
-        json.dump(p, output, indent=4)
+    if args.ndjson:
+        lines = activity_streams.ndjson_activities(collection_uri=collection_uri,
+                                                   service_uri=settings_offline.service_base_address)
+        opener = gzip.open if args.gzip else open
+        with opener(settings_offline.output_file, 'wb') as output:
+            for line in lines:
+                output.write(line)
+    else:
+        number_of_members, member_list = activity_streams.get_members(
+            activity_streams.get_json_resource(resource_uri=collection_uri))
+        activity_streams_pages = activity_streams.streamer(number_of_members=number_of_members,
+                                                           member_list=member_list,
+                                                           top_uri=collection_uri,
+                                                           service_uri=settings_offline.service_base_address,
+                                                           size_of_page=number_of_members)
+        p = activity_streams.page_slicer(activity_streams_pages=activity_streams_pages, position=1)
+        with open(settings_offline.output_file, 'w') as output:
+            json.dump(p, output, indent=4)